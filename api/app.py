@@ -1,15 +1,33 @@
 # Tässä on kaikki sovelluslogiikka. Flask toimii Frameworkina tälle Python-pohjaiselle API:lle. Luotu Claudella.
 # Aluksi projektiin importataan käytettävät kirjastot.
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, request, jsonify, send_file, render_template_string, g, has_request_context
 from PIL import Image, UnidentifiedImageError
 import numpy as np
 import psycopg2
+import psycopg2.extras
 import redis
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter
+from datetime import datetime, timezone
+from functools import wraps
+import socket
+import threading
+import sys
+import gzip
+import math
 import json
 import time
+import uuid
 import io
 import os
 
+# Brotli on valinnainen: ilman sitä pakataan vain gzipillä.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Luodaan Flask-sovellus
 app = Flask(__name__)
 
@@ -18,24 +36,258 @@ DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://postgres:postgres@db
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://redis:6379')
 APP_VERSION = os.environ.get('APP_VERSION', '1.0.0')
 
-# Redis-yhteys (lazy loading)
+# SUORITUSKYKYJÄLJITYS (valinnainen)
+# Kun TRACING_ENABLED=1, jokaisesta pyynnöstä kerätään aikavälit (span): tietokantakyselyt, Redis-kutsut,
+# JSON-serialisointi, pakkaus ja kuvankäsittely. Hitaat pyynnöt kirjataan lokiin erittelyineen ja
+# aikavälit palautetaan myös Server-Timing-otsikossa selaimen kehitystyökaluja varten.
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', '0') == '1'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))  # millisekuntia
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # tyhjä = profilointipääte pois käytöstä
+PROFILE_MAX_SECONDS = 60
+trace_spans = ContextVar('trace_spans', default=None)  # ASGI-pyynnön aikavälit (ks. asgi.TracingMiddleware)
+
+@contextmanager
+def span(name):
+    """Mittaa koodilohkon keston nykyisen pyynnön jäljitykseen."""
+    spans = trace_spans.get()
+    if spans is None:
+        if not TRACING_ENABLED or not has_request_context() or 'spans' not in g:
+            yield
+            return
+        spans = g.spans
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, time.perf_counter() - start))
+
+@app.before_request
+def start_trace():
+    if TRACING_ENABLED:
+        g.spans = []
+        g.trace_start = time.perf_counter()
+
+def report_trace(method, path, status, spans, total_ms):
+    """Kirjaa hidas pyyntö aikaväleineen. Palauttaa Server-Timing-otsikon arvon (yhteinen ASGI-polulle)."""
+    totals, counts = {}, Counter()
+    for name, elapsed in spans:
+        totals[name] = totals.get(name, 0.0) + elapsed * 1000
+        counts[name] += 1
+    if total_ms >= SLOW_REQUEST_MS:
+        breakdown = ", ".join(f'{name} {ms:.1f} ms x{counts[name]}' for name, ms in sorted(totals.items(), key=lambda i: -i[1]))
+        untracked = total_ms - sum(totals.values())
+        print(f"Hidas pyyntö: {method} {path} {status} {total_ms:.1f} ms "
+              f"[{breakdown or 'ei aikavälejä'}; muu {untracked:.1f} ms]")
+    timings = [f'{name};dur={ms:.1f}' for name, ms in totals.items()]
+    return ", ".join(timings + [f'total;dur={total_ms:.1f}'])
+
+@app.after_request
+def finish_trace(response):
+    """Lisää Server-Timing-otsikko ja kirjaa hitaat pyynnöt aikaväleineen."""
+    if not TRACING_ENABLED or 'spans' not in g:
+        return response
+    total_ms = (time.perf_counter() - g.trace_start) * 1000
+    response.headers['Server-Timing'] = report_trace(request.method, request.path, response.status_code, g.spans, total_ms)
+    return response
+
+class TracedCursor(psycopg2.extensions.cursor):
+    """Kursori, jonka kyselyt näkyvät jäljityksessä db-aikavälinä."""
+
+    def execute(self, query, vars=None):
+        with span('db'):
+            return super().execute(query, vars)
+
+def thread_cpu_time(native_id):
+    """Säikeen käyttämä CPU-aika sekunteina, tai None jos säie on jo päättynyt.
+
+    Luetaan /proc:sta käyttöjärjestelmän säie-id:llä eikä pthread_getcpuclockid():llä: päättyneen säikeen kahvan
+    käyttö on musl-libc:ssä (alpine-kuva) määrittelemätöntä. schedstat antaa ajan nanosekunteina, stat kellojaksoina.
+    """
+    try:
+        with open(f'/proc/self/task/{native_id}/schedstat') as f:
+            return int(f.read().split()[0]) / 1e9
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f'/proc/self/task/{native_id}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()  # säikeen nimi voi sisältää välilyöntejä ja sulkeita
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime + stime
+    except (OSError, ValueError, IndexError):
+        return None
+
+def sample_stacks(seconds, interval=0.005, wall=False):
+    """Näytteistä säikeiden pinot annetun ajan. Palauttaa {collapsed-pino: näytemäärä}.
+
+    Oletuksena näyte otetaan vain säikeistä, joiden CPU-aika kasvoi edellisen näytteen jälkeen, joten sleepissä,
+    XREADGROUPissa tai selectissä odottavat säikeet eivät näy profiilissa. wall=True näytteistää kaikki säikeet
+    (wall-clock), jolloin myös odotukset näkyvät.
+    """
+    samples = Counter()
+    me = threading.get_ident()
+    cpu_seen = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        # Pyyntösäikeet ovat lyhytikäisiä, joten säieluettelo haetaan joka näytteellä
+        threads = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            thread = threads.get(ident)
+            if not wall:
+                if thread is None or thread.native_id is None:
+                    continue
+                cpu, previous = thread_cpu_time(thread.native_id), cpu_seen.get(ident)
+                cpu_seen[ident] = cpu
+                if cpu is None or previous is None or cpu <= previous:
+                    continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread.name if thread else f"thread-{ident}")
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+profile_lock = threading.Lock()
+
+@app.route('/debug/profile')
+def profile():
+    """Näytteistä workerin CPU-profiili N sekunnin ajan collapsed-stack-muodossa (flamegraph.pl, speedscope).
+
+    ?mode=wall palauttaa wall-clock-profiilin, jossa näkyvät myös odottavat säikeet. Käytetty tila kerrotaan
+    X-Profile-Mode-otsikossa; ilman /proc-tiedostojärjestelmää (muu kuin Linux) profiili on aina wall-clock.
+    Vaatii PROFILE_TOKEN-ympäristömuuttujan ja saman arvon X-Profile-Token-otsikossa.
+    nginx ei välitä /debug/-polkuja, joten pääte on tavoitettavissa vain sisäverkosta.
+    """
+    if not PROFILE_TOKEN:
+        return jsonify({"error": "Profilointi ei ole käytössä"}), 404
+    if request.headers.get('X-Profile-Token') != PROFILE_TOKEN:
+        return jsonify({"error": "Virheellinen tunniste"}), 403
+    try:
+        seconds = max(1.0, min(PROFILE_MAX_SECONDS, float(request.args.get('seconds', 10))))
+    except ValueError:
+        return jsonify({"error": "Virheellinen seconds-arvo"}), 400
+    wall = request.args.get('mode') == 'wall' or not os.path.isdir('/proc/self/task')
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({"error": "Profilointi on jo käynnissä"}), 409
+    try:
+        samples = sample_stacks(seconds, wall=wall)
+    finally:
+        profile_lock.release()
+    body = "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+    return body, 200, {'Content-Type': 'text/plain; charset=utf-8', 'X-Profile-Mode': 'wall' if wall else 'cpu'}
+
+# Redis-yhteys: jaettu yhteyspooli aikakatkaisuineen ja yksinkertainen katkaisija (circuit breaker).
+# Hidas tai kaatunut Redis ei saa jumittaa pyyntöjä, joten jokaisella kutsulla on tiukka aikaraja
+# ja toistuvien virheiden jälkeen Redis ohitetaan kokonaan jäähdytysajan ajan.
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '0.5'))  # sekuntia
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '0.5'))  # sekuntia
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '20'))
+REDIS_BREAKER_THRESHOLD = int(os.environ.get('REDIS_BREAKER_THRESHOLD', '3'))  # peräkkäisiä virheitä
+REDIS_BREAKER_COOLDOWN = float(os.environ.get('REDIS_BREAKER_COOLDOWN', '10'))  # sekuntia
+
+redis_pool = None
 redis_client = None
-CACHE_KEY = "notes_cache"
+redis_binary_client = None  # tavuina palauttava asiakas esipakatuille välimuistiarvoille
+CACHE_KEY = "notes_cache"  # muistiinpanovälimuistin avainten etuliite, ks. NOTES API
 CACHE_TTL = 60  # sekuntia
 
-def get_redis():
-    """Hae Redis-yhteys (lazy loading)."""
-    global redis_client
+# Katkaisijan tila ja Redis-kutsujen latenssimittarit (/metrics)
+REDIS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+redis_lock = threading.Lock()
+redis_state = {
+    "failures": 0,       # peräkkäiset virheet
+    "open_until": 0.0,   # katkaisija auki tähän hetkeen asti (time.monotonic)
+    "calls": 0,
+    "errors": 0,
+    "skipped": 0,        # katkaisijan takia ohitetut haut
+    "latency_sum": 0.0,
+    "latency_buckets": [0] * len(REDIS_LATENCY_BUCKETS),
+}
+
+@contextmanager
+def redis_call():
+    """Mittaa yhden Redis-kierroksen keston ja päivitä katkaisijan tila."""
+    start = time.perf_counter()
+    try:
+        with span('redis'):
+            yield
+    except (redis.ConnectionError, redis.TimeoutError):
+        with redis_lock:
+            redis_state["errors"] += 1
+            redis_state["failures"] += 1
+            if redis_state["failures"] >= REDIS_BREAKER_THRESHOLD:
+                redis_state["open_until"] = time.monotonic() + REDIS_BREAKER_COOLDOWN
+        raise
+    else:
+        with redis_lock:
+            redis_state["failures"] = 0
+    finally:
+        elapsed = time.perf_counter() - start
+        with redis_lock:
+            redis_state["calls"] += 1
+            redis_state["latency_sum"] += elapsed
+            for i, bound in enumerate(REDIS_LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    redis_state["latency_buckets"][i] += 1
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline, jonka execute() mitataan yhtenä Redis-kierroksena."""
+
+    def execute(self, raise_on_error=True):
+        with redis_call():
+            return super().execute(raise_on_error)
+
+class InstrumentedRedis(redis.Redis):
+    """Redis-asiakas, joka mittaa jokaisen komennon ja syöttää virheet katkaisijalle."""
+
+    def execute_command(self, *args, **options):
+        with redis_call():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def redis_circuit_open():
+    """Onko katkaisija auki, eli ohitetaanko Redis tällä hetkellä."""
+    return time.monotonic() < redis_state["open_until"]
+
+def get_redis(binary=False):
+    """Hae jaettu Redis-asiakas. Palauttaa None, jos katkaisija on auki.
+
+    binary=True palauttaa asiakkaan, joka ei dekoodaa vastauksia merkkijonoiksi (pakatut arvot).
+    """
+    global redis_pool, redis_client, redis_binary_client
+    if redis_circuit_open():
+        with redis_lock:
+            redis_state["skipped"] += 1
+        return None
     if redis_client is None:
-        try:
-            redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-        except:
-            pass
-    return redis_client
+        with redis_lock:
+            if redis_client is None:
+                try:
+                    # BlockingConnectionPool odottaa vapaata yhteyttä enintään timeout-ajan eikä avaa rajattomasti uusia.
+                    pool_options = dict(
+                        max_connections=REDIS_MAX_CONNECTIONS,
+                        timeout=REDIS_SOCKET_TIMEOUT,
+                        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                        socket_timeout=REDIS_SOCKET_TIMEOUT,
+                        health_check_interval=30,
+                    )
+                    redis_pool = redis.BlockingConnectionPool.from_url(REDIS_URL, decode_responses=True, **pool_options)
+                    binary_pool = redis.BlockingConnectionPool.from_url(REDIS_URL, **pool_options)
+                    redis_binary_client = InstrumentedRedis(connection_pool=binary_pool)
+                    redis_client = InstrumentedRedis(connection_pool=redis_pool)
+                except ValueError as e:
+                    print(f"Virheellinen REDIS_URL: {e}")
+    return redis_binary_client if binary else redis_client
 
 def get_db():
     """Luo PostgreSQL-tietokantayhteys."""
-    conn = psycopg2.connect(DATABASE_URL)
+    with span('db.connect'):
+        conn = psycopg2.connect(DATABASE_URL, cursor_factory=TracedCursor)
     return conn
 
 def init_db(max_retries=30, delay=1):
@@ -74,6 +326,12 @@ def init_db(max_retries=30, delay=1):
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # Revisio kasvaa jokaisella päivityksellä; välimuisti hylkää sitä vanhemmat myöhässä saapuvat päivitykset
+            cur.execute("ALTER TABLE notes ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 1")
+            # Write-behind: idempotenssiavain estää saman kirjoituksen tallentumisen kahdesti uudelleenyrityksissä
+            for table in ("notes", "scoreboard"):
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64)")
+                cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_idempotency_key ON {table} (idempotency_key)")
             conn.commit()
             cur.close()
             conn.close()
@@ -85,26 +343,331 @@ def init_db(max_retries=30, delay=1):
     print("Tietokantaan ei saatu yhteyttä!")
     return False
 
-def invalidate_cache():
-    """Tyhjennä Redis-välimuisti."""
+# VASTAUSTEN PAKKAUS
+# JSON-vastaukset pakataan sovelluksessa, koska nginx ei pakkaa API-vastauksia (gzip off /api/-sijainnissa).
+# Näin samaa vastausta ei pakata kahdesti, ja välimuistissa olevat vastaukset voidaan pakata valmiiksi.
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))  # tavua
+COMPRESSION_ENCODINGS = [e.strip() for e in os.environ.get('COMPRESSION_ENCODINGS', 'br,gzip').split(',') if e.strip()]
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+def available_encodings():
+    """Käytössä olevat pakkausmenetelmät etusijajärjestyksessä."""
+    return [e for e in COMPRESSION_ENCODINGS if e == 'gzip' or (e == 'br' and brotli is not None)]
+
+def choose_encoding():
+    """Valitse asiakkaan Accept-Encoding-otsikon perusteella pakkaus, tai 'identity'."""
+    for encoding in available_encodings():
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return 'identity'
+
+def compress(data, encoding):
+    """Pakkaa tavut annetulla menetelmällä."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL)
+    return data
+
+def encode_variants(payload):
+    """Muodosta vastauksesta pakkaamaton ja pakatut versiot (pienet vastaukset vain pakkaamattomana)."""
+    variants = {'identity': payload}
+    if len(payload) >= COMPRESSION_MIN_SIZE:
+        for encoding in available_encodings():
+            variants[encoding] = compress(payload, encoding)
+    return variants
+
+def bytes_response(body, encoding='identity', status=200, mimetype='application/json'):
+    """Palauta valmiiksi serialisoitu (ja mahdollisesti pakattu) vastaus sellaisenaan."""
+    response = app.response_class(body, status=status, mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Pakkaa riittävän suuret JSON-vastaukset, joita käsittelijä ei ole jo pakannut."""
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or not 200 <= response.status_code < 300):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    encoding = choose_encoding()
+    if encoding == 'identity' or len(data) < COMPRESSION_MIN_SIZE:
+        return response
+    with span('compress'):
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# PYYNTÖRAJOITUS JA KUORMANHALLINTA
+# Token bucket -rajoitin asiakkaan IP-osoitteen mukaan (X-Real-IP, jonka nginx asettaa). Tila on Redisissä,
+# ja päivitys tehdään atomisesti Lua-skriptillä, joten raja on yhteinen kaikille workereille.
+# Jos Redis ei ole käytettävissä, pyynnöt päästetään läpi (fail open).
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', '5'))  # tokenia sekunnissa
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '30'))  # ämpärin koko
+RATE_LIMIT_PREFIX = "ratelimit:"
+
+# Pyynnön hinta tokeneina (endpoint, metodi) -parin mukaan. Muut /api/-pyynnöt maksavat 1.
+RATE_LIMIT_COSTS = {
+    ('process_image', 'POST'): 10,
+    ('add_to_scoreboard', 'POST'): 3,
+    ('notes', 'POST'): 2,
+    ('memory_save', 'POST'): 2,
+}
+
+# Raskaiden pyyntöjen samanaikaisuusraja: ylikuormassa vastataan nopeasti 503 eikä jonoteta loputtomiin.
+EXPENSIVE_CONCURRENCY = int(os.environ.get('EXPENSIVE_CONCURRENCY', '4'))
+EXPENSIVE_QUEUE_TIMEOUT = float(os.environ.get('EXPENSIVE_QUEUE_TIMEOUT', '2'))  # sekuntia
+expensive_slots = threading.BoundedSemaphore(EXPENSIVE_CONCURRENCY)
+
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+token_bucket_script = None
+
+admission_lock = threading.Lock()
+admission_state = {
+    "rate_limited": 0,  # 429-vastaukset
+    "overloaded": 0,    # 503-vastaukset samanaikaisuusrajan takia
+    "expensive_in_flight": 0,
+}
+
+def client_ip():
+    """Asiakkaan IP-osoite. nginx välittää sen X-Real-IP-otsikossa (tunnelin kautta CF-Connecting-IP:stä, ks. nginx.conf)."""
+    return request.headers.get('X-Real-IP') or request.remote_addr or 'unknown'
+
+def take_tokens(r, key, cost):
+    """Vähennä ämpäristä cost tokenia. Palauttaa (sallittu, odotusaika sekunteina)."""
+    global token_bucket_script
+    if token_bucket_script is None:
+        token_bucket_script = r.register_script(TOKEN_BUCKET_LUA)
+    allowed, retry_after = token_bucket_script(keys=[key], args=[RATE_LIMIT_RATE, RATE_LIMIT_BURST, cost], client=r)
+    return int(allowed) == 1, float(retry_after)
+
+def too_busy(error, status, retry_after):
+    """Ylikuormavastaus Retry-After-otsikolla."""
+    response = jsonify({"error": error})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@app.before_request
+def rate_limit():
+    """Rajoita /api/-pyyntöjä asiakaskohtaisesti token bucket -algoritmilla."""
+    if not RATE_LIMIT_ENABLED or not request.path.startswith('/api/'):
+        return None
     r = get_redis()
-    if r:
+    if not r:
+        return None
+    cost = RATE_LIMIT_COSTS.get((request.endpoint, request.method), 1)
+    try:
+        allowed, retry_after = take_tokens(r, RATE_LIMIT_PREFIX + client_ip(), cost)
+    except redis.RedisError:
+        return None
+    if allowed:
+        return None
+    with admission_lock:
+        admission_state["rate_limited"] += 1
+    return too_busy("Liian monta pyyntöä, yritä hetken kuluttua uudelleen", 429, retry_after)
+
+def expensive(view):
+    """Rajoita raskaiden (muiden kuin GET) pyyntöjen samanaikaista määrää."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+        if not expensive_slots.acquire(timeout=EXPENSIVE_QUEUE_TIMEOUT):
+            with admission_lock:
+                admission_state["overloaded"] += 1
+            return too_busy("Palvelu on ylikuormitettu, yritä hetken kuluttua uudelleen", 503, 1)
+        with admission_lock:
+            admission_state["expensive_in_flight"] += 1
         try:
-            r.delete(CACHE_KEY)
-        except:
-            pass
+            return view(*args, **kwargs)
+        finally:
+            with admission_lock:
+                admission_state["expensive_in_flight"] -= 1
+            expensive_slots.release()
+    return wrapper
+
+def admission_metrics():
+    """Pyyntörajoituksen ja kuormanhallinnan laskurit Prometheus-muodossa."""
+    with admission_lock:
+        state = dict(admission_state)
+    return f"""# HELP http_rate_limited_total Requests rejected by the per-client rate limiter
+# TYPE http_rate_limited_total counter
+http_rate_limited_total {state["rate_limited"]}
+# HELP http_overloaded_total Expensive requests rejected by the concurrency cap
+# TYPE http_overloaded_total counter
+http_overloaded_total {state["overloaded"]}
+# HELP http_expensive_in_flight Expensive requests currently being processed
+# TYPE http_expensive_in_flight gauge
+http_expensive_in_flight {state["expensive_in_flight"]}
+"""
 
 # HEALTH CHECK
+# /health kertoo vain, että prosessi elää (liveness). /ready kertoo, voiko API ottaa liikennettä vastaan (readiness):
+# warm-up on valmis ja PostgreSQL vastaa. Riippuvuudet tarkistaa taustasäie muutaman sekunnin välein, ja /ready
+# palauttaa viimeisimmän tuloksen muistista, joten terveystarkistukset eivät kuormita tietokantaa lainkaan.
+READY_PROBE_INTERVAL = float(os.environ.get('READY_PROBE_INTERVAL', '2'))  # sekuntia
+READY_PROBE_TIMEOUT = 2  # sekuntia
+app_ready = threading.Event()
+dependency_status = {"checked_at": 0.0, "checks": {}}  # korvataan kokonaan jokaisella kierroksella
+probe_conn = None  # tarkistimen oma pysyvä tietokantayhteys
+probe_errors = {}  # viimeksi lokiin kirjattu virhe tarkistuksittain
+
+def probe_failed(name, error):
+    """Kirjaa virheen yksityiskohdat lokiin (vain muuttuessa) ja palauta vastaukseen kiinteä virheteksti.
+
+    Ajurien virheilmoitukset sisältävät sisäverkon osoitteita ja portteja, joita /ready ei saa paljastaa.
+    """
+    detail = str(error).strip()
+    if probe_errors.get(name) != detail:
+        probe_errors[name] = detail
+        print(f"Riippuvuustarkistus {name} epäonnistui: {detail}")
+    return {"ok": False, "error": "ei käytettävissä"}
+
+def probe_postgres():
+    """Tarkista PostgreSQL kevyellä SELECT 1 -kyselyllä tarkistimen omaa yhteyttä käyttäen."""
+    global probe_conn
+    try:
+        if probe_conn is None or probe_conn.closed:
+            probe_conn = psycopg2.connect(DATABASE_URL, connect_timeout=READY_PROBE_TIMEOUT,
+                                          options=f'-c statement_timeout={READY_PROBE_TIMEOUT * 1000}')
+            probe_conn.autocommit = True
+        cur = probe_conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        return {"ok": True}
+    except psycopg2.Error as e:
+        if probe_conn is not None:
+            probe_conn.close()
+        probe_conn = None
+        return probe_failed("postgres", e)
+
+def probe_redis():
+    """Tarkista Redis PING-komennolla. Redis on valinnainen, joten virhe tarkoittaa heikentynyttä tilaa."""
+    r = get_redis()
+    if not r:
+        return {"ok": False, "error": "katkaisija auki"}
+    try:
+        r.ping()
+        return {"ok": True}
+    except redis.RedisError as e:
+        return probe_failed("redis", e)
+
+def probe_workers():
+    """Raskaiden pyyntöjen paikat ja säikeiden määrä."""
+    with admission_lock:
+        in_flight = admission_state["expensive_in_flight"]
+    return {
+        "ok": in_flight < EXPENSIVE_CONCURRENCY,
+        "expensive_in_flight": in_flight,
+        "expensive_capacity": EXPENSIVE_CONCURRENCY,
+        "threads": threading.active_count(),
+    }
+
+def probe_dependencies():
+    """Aja kaikki tarkistukset kerran ja julkaise tulokset kerralla."""
+    global dependency_status
+    checks = {}
+    for name, probe in (("postgres", probe_postgres), ("redis", probe_redis), ("workers", probe_workers)):
+        start = time.perf_counter()
+        result = probe()
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        if result["ok"]:
+            probe_errors.pop(name, None)
+        checks[name] = result
+    dependency_status = {"checked_at": time.time(), "checks": checks}
+
+def dependency_prober():
+    """Taustasäie, joka päivittää riippuvuuksien tilan READY_PROBE_INTERVAL välein."""
+    while True:
+        probe_dependencies()
+        time.sleep(READY_PROBE_INTERVAL)
+
 @app.route('/health')
 def health():
     return "OK", 200
 
+@app.route('/ready')
+def ready():
+    """Readiness välimuistissa olevista tarkistuksista: 200 kun warm-up on valmis ja PostgreSQL vastaa."""
+    current = dependency_status
+    checks = current["checks"]
+    age = time.time() - current["checked_at"]
+    if not checks or age > READY_PROBE_INTERVAL * 3:
+        status = "unknown"  # tarkistin ei ole vielä ajanut tai on jumissa
+    elif not checks["postgres"]["ok"]:
+        status = "unavailable"
+    elif not app_ready.is_set():
+        status = "warming up"
+    elif not all(check["ok"] for check in checks.values()):
+        status = "degraded"  # palvelee, mutta ilman välimuistia tai ruuhkassa
+    else:
+        status = "ready"
+    code = 200 if status in ("ready", "degraded") else 503
+    return jsonify({
+        "status": status,
+        "age_ms": round(age * 1000, 1) if checks else None,
+        "checks": checks,
+    }), code
+
 # VERSION
 @app.route('/version')
 def version():
     """Palauta sovelluksen versio."""
     return jsonify({"version": APP_VERSION})
 
+def redis_metrics():
+    """Redis-kutsujen latenssi ja katkaisijan tila Prometheus-muodossa."""
+    with redis_lock:
+        state = dict(redis_state, latency_buckets=list(redis_state["latency_buckets"]))
+    lines = [
+        "# HELP redis_command_duration_seconds Redis round trip latency",
+        "# TYPE redis_command_duration_seconds histogram",
+    ]
+    for bound, count in zip(REDIS_LATENCY_BUCKETS, state["latency_buckets"]):
+        lines.append(f'redis_command_duration_seconds_bucket{{le="{bound}"}} {count}')
+    lines += [
+        f'redis_command_duration_seconds_bucket{{le="+Inf"}} {state["calls"]}',
+        f'redis_command_duration_seconds_sum {state["latency_sum"]:.6f}',
+        f'redis_command_duration_seconds_count {state["calls"]}',
+        "# HELP redis_errors_total Redis connection and timeout errors",
+        "# TYPE redis_errors_total counter",
+        f'redis_errors_total {state["errors"]}',
+        "# HELP redis_skipped_total Redis lookups skipped while the circuit breaker was open",
+        "# TYPE redis_skipped_total counter",
+        f'redis_skipped_total {state["skipped"]}',
+        "# HELP redis_circuit_open Redis circuit breaker is open",
+        "# TYPE redis_circuit_open gauge",
+        f'redis_circuit_open {1 if redis_circuit_open() else 0}',
+    ]
+    return "\n".join(lines) + "\n"
+
 # METRICS (Prometheus)
 @app.route('/metrics')
 def metrics():
@@ -127,10 +690,445 @@ notes_total {notes_count}
 # HELP app_up Application is up
 # TYPE app_up gauge
 app_up 1
-"""
+""" + redis_metrics() + admission_metrics() + write_behind_metrics()
     return metrics_text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
 
+# WRITE-BEHIND (valinnainen)
+# Kun WRITE_BEHIND_ENABLED=1, muistiinpanot ja tulokset kirjoitetaan ensin Redis-streamiin (AOF-pysyvyys, ks. compose)
+# ja kuitataan heti (202). Taustasäie purkaa streamin PostgreSQLiin erissä idempotenssiavaimin, joten lyhyt
+# tietokantakatko ei hävitä kirjoituksia eikä uudelleenyritys tallenna samaa riviä kahdesti.
+# Jos Redis ei ole käytettävissä, kirjoitetaan suoraan tietokantaan kuten ennenkin.
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '0') == '1'
+WRITE_BEHIND_STREAM = "write_behind"
+WRITE_BEHIND_GROUP = "flusher"
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', '100'))
+WRITE_BEHIND_BLOCK_MS = 1000  # kuinka kauan purkaja odottaa uusia merkintöjä kerralla
+WRITE_BEHIND_CLAIM_IDLE_MS = 30000  # kaatuneen workerin kesken jääneet merkinnät otetaan haltuun tämän jälkeen
+WRITE_BEHIND_DEAD_STREAM = "write_behind_dead"  # merkinnät, joita ei saatu kirjoitettua tietokantaan
+WRITE_BEHIND_DEAD_MAXLEN = 10000
+
+write_behind_lock = threading.Lock()
+write_behind_state = {
+    "flushed": 0,
+    "dead_lettered": 0,
+    "errors": 0,
+    "last_flush_seconds": 0.0,
+}
+
+def enqueue_write(kind, data):
+    """Lisää kirjoitus write-behind-streamiin. Palauttaa idempotenssiavaimen, tai None jos Redis ei ole käytettävissä."""
+    r = get_redis()
+    if not r:
+        return None
+    # Asiakas voi antaa oman avaimen, jolloin sen uudelleenyritykset eivät tuota kaksoiskappaleita
+    key = (request.headers.get('Idempotency-Key') or uuid.uuid4().hex)[:64]
+    try:
+        r.xadd(WRITE_BEHIND_STREAM, {"kind": kind, "key": key, "data": json.dumps(data)})
+        return key
+    except redis.RedisError:
+        return None
+
+def accepted_at(entry_id):
+    """Stream-merkinnän vastaanottohetki (UTC, ilman aikavyöhykettä kuten tietokannan oletusarvot)."""
+    millis = int(entry_id.split('-')[0])
+    return datetime.fromtimestamp(millis / 1000, timezone.utc).replace(tzinfo=None)
+
+# Yhteysvirheet tarkoittavat, että tietokanta ei ole käytettävissä: erä yritetään myöhemmin kokonaan uudelleen.
+# Muut virheet (esim. DataError tai NUL-merkki tekstissä) koskevat yksittäistä riviä, joka siirretään sivuun.
+DB_UNAVAILABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def write_rows(conn, note_rows, score_rows):
+    """Kirjoita rivit yhdessä transaktiossa. Palauttaa uudet muistiinpanorivit välimuistin päivitystä varten."""
+    inserted_notes = []
+    cur = conn.cursor()
+    if note_rows:
+        # Jo aiemmin tallennetut (konfliktoivat) rivit eivät palaudu, joten välimuistiin päivitetään vain uudet
+        inserted_notes = psycopg2.extras.execute_values(cur, """
+            INSERT INTO notes (title, content, created_at, idempotency_key) VALUES %s
+            ON CONFLICT (idempotency_key) DO NOTHING
+            RETURNING id, title, content, created_at, updated_at, revision
+        """, note_rows, fetch=True)
+    if score_rows:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO scoreboard (grid_size, name, time_seconds, moves, created_at, idempotency_key) VALUES %s
+            ON CONFLICT (idempotency_key) DO NOTHING
+        """, score_rows)
+        for grid_size in {row[0] for row in score_rows}:
+            trim_scoreboard(cur, grid_size)
+    conn.commit()
+    cur.close()
+    return inserted_notes
+
+def flush_write_behind(r, entries):
+    """Kirjoita erä stream-merkintöjä tietokantaan yhdessä transaktiossa ja kuittaa ne.
+
+    Jos erä kaatuu muuhun kuin yhteysvirheeseen, rivit kirjoitetaan yksitellen ja edelleen epäonnistuvat
+    siirretään dead letter -streamiin, jottei yksi virheellinen merkintä pysäytä koko jonoa.
+    """
+    parsed, dead = [], []  # parsed: (entry_id, kind, row); dead: (entry_id, fields, virhe)
+    for entry_id, fields in entries:
+        if not fields:
+            continue  # jo poistettu merkintä, pelkkä kuittaus riittää
+        try:
+            data = json.loads(fields["data"])
+            if fields["kind"] == "note":
+                parsed.append((entry_id, "note", (data["title"], data["content"], accepted_at(entry_id), fields["key"])))
+            elif fields["kind"] == "score":
+                parsed.append((entry_id, "score", (data["grid_size"], data["name"], data["time"], data["moves"], accepted_at(entry_id), fields["key"])))
+        except (KeyError, ValueError) as e:
+            dead.append((entry_id, fields, str(e)))
+    note_rows = [row for _, kind, row in parsed if kind == "note"]
+    score_rows = [row for _, kind, row in parsed if kind == "score"]
+
+    start = time.perf_counter()
+    inserted_notes, failed_rows, written_notes = [], 0, 0
+    if parsed:
+        conn = get_db()
+        try:
+            try:
+                inserted_notes = write_rows(conn, note_rows, score_rows)
+                written_notes = len(note_rows)
+            except DB_UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                conn.rollback()
+                print(f"Write-behind erä epäonnistui, kirjoitetaan rivit yksitellen: {e}")
+                fields_by_id = dict(entries)
+                for entry_id, kind, row in parsed:
+                    try:
+                        inserted_notes += write_rows(conn, [row] if kind == "note" else [], [row] if kind == "score" else [])
+                        written_notes += kind == "note"
+                    except DB_UNAVAILABLE_ERRORS:
+                        raise
+                    except Exception as e:
+                        conn.rollback()
+                        failed_rows += 1
+                        dead.append((entry_id, fields_by_id[entry_id], str(e)))
+        finally:
+            conn.close()
+
+    # Välimuistit päivitetään ennen kuittausta, jottei kuittauksen jälkeinen kaatuminen jätä niitä vanhoiksi.
+    # Uudelleen puretut merkinnät (kuittaus epäonnistui tai worker kaatui commitin jälkeen) eivät palauta rivejä
+    # (ON CONFLICT DO NOTHING), joten niitä ei voi päivittää välimuistiin yksitellen: välimuisti rakennetaan uudelleen.
+    if len(inserted_notes) < written_notes:
+        invalidate_cache()
+    elif inserted_notes:
+        patch_notes_cache(upserts=inserted_notes)
+    for grid_size in {row[0] for row in score_rows}:
+        invalidate_scoreboard_cache(grid_size)
+
+    # Kuittaus vasta onnistuneen commitin jälkeen. Jos kuittaus epäonnistuu, merkinnät puretaan uudelleen ja
+    # idempotenssiavain estää kaksoiskappaleet.
+    ids = [entry_id for entry_id, _ in entries]
+    pipe = r.pipeline()
+    for entry_id, fields, error in dead:
+        print(f"Write-behind siirsi merkinnän {entry_id} dead letter -streamiin: {error}")
+        pipe.xadd(WRITE_BEHIND_DEAD_STREAM, {**fields, "entry_id": entry_id, "error": error[:500]},
+                  maxlen=WRITE_BEHIND_DEAD_MAXLEN, approximate=True)
+    pipe.xack(WRITE_BEHIND_STREAM, WRITE_BEHIND_GROUP, *ids)
+    pipe.xdel(WRITE_BEHIND_STREAM, *ids)
+    pipe.execute()
+
+    with write_behind_lock:
+        write_behind_state["flushed"] += len(parsed) - failed_rows
+        write_behind_state["dead_lettered"] += len(dead)
+        write_behind_state["last_flush_seconds"] = time.perf_counter() - start
+
+def read_entries(response):
+    """XREADGROUP-vastauksesta merkintälista."""
+    return response[0][1] if response else []
+
+def write_behind_flusher():
+    """Taustasäie, joka purkaa write-behind-streamin tietokantaan."""
+    # Oma asiakas: estävä XREADGROUP kestää pidempään kuin pyyntöpolun tiukka socket-aikaraja.
+    r = redis.from_url(REDIS_URL, decode_responses=True, socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                       socket_timeout=WRITE_BEHIND_BLOCK_MS / 1000 + 5)
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    group_ready = False
+    last_claim = 0.0
+    backoff = 1
+    while True:
+        try:
+            if not group_ready:
+                try:
+                    r.xgroup_create(WRITE_BEHIND_STREAM, WRITE_BEHIND_GROUP, id='0', mkstream=True)
+                except redis.ResponseError as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+                group_ready = True
+            # Ensin omat kesken jääneet (esim. tietokantavirheen jälkeen), sitten kaatuneiden workerien, lopuksi uudet
+            entries = read_entries(r.xreadgroup(WRITE_BEHIND_GROUP, consumer, {WRITE_BEHIND_STREAM: '0'}, count=WRITE_BEHIND_BATCH))
+            if not entries and time.monotonic() - last_claim > WRITE_BEHIND_CLAIM_IDLE_MS / 1000:
+                last_claim = time.monotonic()
+                entries = r.xautoclaim(WRITE_BEHIND_STREAM, WRITE_BEHIND_GROUP, consumer,
+                                       min_idle_time=WRITE_BEHIND_CLAIM_IDLE_MS, count=WRITE_BEHIND_BATCH)[1]
+            if not entries:
+                entries = read_entries(r.xreadgroup(WRITE_BEHIND_GROUP, consumer, {WRITE_BEHIND_STREAM: '>'},
+                                                    count=WRITE_BEHIND_BATCH, block=WRITE_BEHIND_BLOCK_MS))
+            if entries:
+                flush_write_behind(r, entries)
+            backoff = 1
+        except Exception as e:
+            # Säie ei saa kuolla: muuten jono kasvaa eikä mitään enää kirjoiteta tietokantaan
+            with write_behind_lock:
+                write_behind_state["errors"] += 1
+            print(f"Write-behind purku epäonnistui, yritetään uudelleen {backoff} s kuluttua: {e!r}")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+def write_behind_metrics():
+    """Jonon syvyys ja purkuviive Prometheus-muodossa."""
+    if not WRITE_BEHIND_ENABLED:
+        return ""
+    depth, dead_depth, lag = 0, 0, 0.0
+    r = get_redis()
+    if r:
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.xlen(WRITE_BEHIND_STREAM)
+            pipe.xrange(WRITE_BEHIND_STREAM, count=1)
+            pipe.xlen(WRITE_BEHIND_DEAD_STREAM)
+            depth, oldest, dead_depth = pipe.execute()
+            if oldest:
+                lag = max(0.0, time.time() - int(oldest[0][0].split('-')[0]) / 1000)
+        except redis.RedisError:
+            pass
+    with write_behind_lock:
+        state = dict(write_behind_state)
+    return f"""# HELP write_behind_queue_depth Writes accepted but not yet flushed to PostgreSQL
+# TYPE write_behind_queue_depth gauge
+write_behind_queue_depth {depth}
+# HELP write_behind_lag_seconds Age of the oldest unflushed write
+# TYPE write_behind_lag_seconds gauge
+write_behind_lag_seconds {lag:.3f}
+# HELP write_behind_flushed_total Writes flushed to PostgreSQL
+# TYPE write_behind_flushed_total counter
+write_behind_flushed_total {state["flushed"]}
+# HELP write_behind_dead_lettered_total Writes moved to the dead-letter stream after failing on their own
+# TYPE write_behind_dead_lettered_total counter
+write_behind_dead_lettered_total {state["dead_lettered"]}
+# HELP write_behind_dead_letter_depth Entries waiting in the dead-letter stream
+# TYPE write_behind_dead_letter_depth gauge
+write_behind_dead_letter_depth {dead_depth}
+# HELP write_behind_flush_errors_total Failed flush attempts
+# TYPE write_behind_flush_errors_total counter
+write_behind_flush_errors_total {state["errors"]}
+# HELP write_behind_last_flush_seconds Duration of the last flush batch
+# TYPE write_behind_last_flush_seconds gauge
+write_behind_last_flush_seconds {state["last_flush_seconds"]:.6f}
+"""
+
 # NOTES API
+# Muistiinpanovälimuisti on muistiinpanokohtainen: hash id -> valmiiksi serialisoitu muistiinpano ja sorted set id:istä.
+# Kirjoitukset päivittävät vain muuttuneen muistiinpanon, ja listat ja sivut kootaan välimuistista yhdellä kierroksella.
+# Koko välimuisti rakennetaan tietokannasta vain, kun valmiusmerkki puuttuu (kylmä käynnistys tai epäonnistunut päivitys).
+# Koko listan pakatut versiot tallennetaan sukupolvinumeron kanssa, jolloin pakkaus tehdään kerran kirjoitusta kohden.
+NOTES_ITEMS_KEY = f"{CACHE_KEY}:items"   # hash: id -> muistiinpano JSONina
+NOTES_IDS_KEY = f"{CACHE_KEY}:ids"       # sorted set: id (pisteenä id)
+NOTES_READY_KEY = f"{CACHE_KEY}:ready"   # olemassa = hash ja sorted set vastaavat tietokantaa
+NOTES_GEN_KEY = f"{CACHE_KEY}:gen"       # kasvaa jokaisella muutoksella, pakatut versiot sidotaan tähän
+NOTES_REVISIONS_KEY = f"{CACHE_KEY}:revisions"  # hash: id -> viimeisin välimuistiin viety revisio tai 'deleted'
+NOTES_CACHE_TTL = 3600  # sekuntia; valmiusmerkin vanheneminen on varaverkko mahdolliselle ajautumiselle
+NOTES_PAGE_MAX = 500
+
+# Palauttaa [sukupolvi, muistiinpano...] uusimmasta vanhimpaan, tai nil jos välimuisti ei ole valmis.
+NOTES_READ_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local stop = -1
+if tonumber(ARGV[2]) >= 0 then
+    stop = tonumber(ARGV[1]) + tonumber(ARGV[2]) - 1
+end
+local ids = redis.call('ZREVRANGE', KEYS[2], ARGV[1], stop)
+local result = {redis.call('GET', KEYS[4]) or '0'}
+for i = 1, #ids, 1000 do
+    local notes = redis.call('HMGET', KEYS[3], unpack(ids, i, math.min(i + 999, #ids)))
+    for _, note in ipairs(notes) do
+        if note then
+            table.insert(result, note)
+        end
+    end
+end
+return result
+"""
+
+# Tallentaa pakatun koko listan vain, jos sukupolvi ei ole muuttunut luvun jälkeen.
+NOTES_STORE_VARIANT_LUA = """
+if (redis.call('GET', KEYS[1]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return 0
+"""
+# Päivittää muistiinpanon vain, jos sen revisio on uudempi kuin välimuistissa, joten samanaikaisten kirjoitusten
+# päivitykset voivat saapua missä järjestyksessä tahansa. Poisto jättää merkinnän 'deleted', ettei myöhässä saapuva
+# päivitys palauta poistettua muistiinpanoa listaan.
+# ARGV: päivitysten määrä, päivitykset kolmikkoina (id, revisio, JSON), poistettavat id:t.
+NOTES_PATCH_LUA = """
+local upserts = tonumber(ARGV[1])
+for i = 2, 1 + upserts * 3, 3 do
+    local current = redis.call('HGET', KEYS[3], ARGV[i])
+    if current ~= 'deleted' and tonumber(ARGV[i + 1]) > tonumber(current or '0') then
+        redis.call('HSET', KEYS[3], ARGV[i], ARGV[i + 1])
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        redis.call('ZADD', KEYS[2], ARGV[i], ARGV[i])
+    end
+end
+for i = 2 + upserts * 3, #ARGV do
+    redis.call('HSET', KEYS[3], ARGV[i], 'deleted')
+    redis.call('HDEL', KEYS[1], ARGV[i])
+    redis.call('ZREM', KEYS[2], ARGV[i])
+end
+redis.call('INCR', KEYS[4])
+for i = 5, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+return 0
+"""
+# Poistaa revisiohashista merkinnät id:ille ARGV[1] asti (uudelleenrakennus kirjoittaa niistä ajantasaiset perään).
+# Näin poistomerkinnät eivät kasva rajatta: suurimman id:n yläpuolelle jäävät vain tilannekuvan jälkeiset.
+NOTES_PRUNE_REVISIONS_LUA = """
+local entries = redis.call('HKEYS', KEYS[1])
+local max_id = tonumber(ARGV[1])
+for _, id in ipairs(entries) do
+    if tonumber(id) <= max_id then
+        redis.call('HDEL', KEYS[1], id)
+    end
+end
+return 0
+"""
+notes_read_script = None
+notes_store_variant_script = None
+notes_patch_script = None
+notes_cache_dirty = False  # päivitys epäonnistui Redis-katkon aikana, välimuisti rakennetaan uudelleen
+
+def cache_variant_key(encoding):
+    """Välimuistiavain koko muistiinpanolistan pakatulle versiolle."""
+    return f"{CACHE_KEY}:{encoding}"
+
+def note_json(row):
+    """Muistiinpanorivi (id, title, content, created_at, updated_at, revision) JSON-tavuina."""
+    return json.dumps({
+        "id": row[0],
+        "title": row[1],
+        "content": row[2],
+        "created_at": row[3].isoformat() + 'Z' if row[3] else None,
+        "updated_at": row[4].isoformat() + 'Z' if row[4] else None
+    }).encode('utf-8')
+
+def json_array(items):
+    """Kokoa valmiiksi serialisoiduista alkioista JSON-taulukko ilman uudelleenserialisointia."""
+    return b"[" + b",".join(items) + b"]"
+
+def invalidate_cache():
+    """Merkitse muistiinpanovälimuisti vanhentuneeksi, jolloin seuraava luku rakentaa sen uudelleen."""
+    global notes_cache_dirty
+    r = get_redis()
+    if r:
+        try:
+            r.delete(NOTES_READY_KEY, *[cache_variant_key(e) for e in available_encodings()])
+            notes_cache_dirty = False
+            return
+        except redis.RedisError:
+            pass
+    notes_cache_dirty = True
+
+def notes_patch_keys_args(upserts=(), deletes=()):
+    """NOTES_PATCH_LUA:n avaimet ja argumentit tietokantariveistä ja poistetuista id:istä (yhteinen ASGI-polulle)."""
+    keys = [NOTES_ITEMS_KEY, NOTES_IDS_KEY, NOTES_REVISIONS_KEY, NOTES_GEN_KEY,
+            *[cache_variant_key(e) for e in available_encodings()]]
+    args = [len(upserts)]
+    for row in upserts:
+        args += [row[0], row[5], note_json(row)]
+    return keys, args + list(deletes)
+
+def queue_notes_rebuild(pipe, rows, items):
+    """Lisää pipelineen koko muistiinpanovälimuistin korvaaminen tietokantariveillä ja niiden JSON-alkioilla."""
+    variants = encode_variants(json_array(items))
+    pipe.delete(NOTES_ITEMS_KEY, NOTES_IDS_KEY, *[cache_variant_key(e) for e in available_encodings()])
+    if rows:
+        pipe.hset(NOTES_ITEMS_KEY, mapping={row[0]: item for row, item in zip(rows, items)})
+        pipe.zadd(NOTES_IDS_KEY, {row[0]: row[0] for row in rows})
+        # Tilannekuvan id-alueen merkinnät korvataan riveillä; suuremmat id:t (poistomerkinnät) säilyvät
+        pipe.eval(NOTES_PRUNE_REVISIONS_LUA, 1, NOTES_REVISIONS_KEY, max(row[0] for row in rows))
+        pipe.hset(NOTES_REVISIONS_KEY, mapping={row[0]: row[5] for row in rows})
+    pipe.incr(NOTES_GEN_KEY)
+    for encoding, body in variants.items():
+        if encoding != 'identity':
+            pipe.setex(cache_variant_key(encoding), CACHE_TTL, body)
+    pipe.setex(NOTES_READY_KEY, NOTES_CACHE_TTL, 1)
+
+def patch_notes_cache(upserts=(), deletes=()):
+    """Päivitä välimuistiin vain muuttuneet muistiinpanot. upserts: tietokantarivit, deletes: id:t."""
+    global notes_patch_script
+    r = get_redis()
+    if r and not notes_cache_dirty:
+        try:
+            if notes_patch_script is None:
+                notes_patch_script = r.register_script(NOTES_PATCH_LUA)
+            keys, args = notes_patch_keys_args(upserts, deletes)
+            notes_patch_script(keys=keys, args=args, client=r)
+            return
+        except redis.RedisError:
+            pass
+    # Päivitys ei onnistunut: välimuistiin ei voi luottaa ennen täyttä uudelleenrakennusta
+    invalidate_cache()
+
+def read_notes_cache(r, offset=0, limit=None):
+    """Lue muistiinpanot välimuistista yhdellä kierroksella. Palauttaa (sukupolvi, alkiot) tai None."""
+    global notes_read_script
+    if notes_read_script is None:
+        notes_read_script = r.register_script(NOTES_READ_LUA)
+    result = notes_read_script(keys=[NOTES_READY_KEY, NOTES_IDS_KEY, NOTES_ITEMS_KEY, NOTES_GEN_KEY],
+                               args=[offset, -1 if limit is None else limit], client=r)
+    if result is None:
+        return None
+    return result[0], result[1:]
+
+def store_notes_variant(r, generation, encoding, body):
+    """Tallenna koko listan pakattu versio, ellei välimuisti ole muuttunut sillä välin."""
+    global notes_store_variant_script
+    if notes_store_variant_script is None:
+        notes_store_variant_script = r.register_script(NOTES_STORE_VARIANT_LUA)
+    notes_store_variant_script(keys=[NOTES_GEN_KEY, cache_variant_key(encoding)],
+                               args=[generation, body, CACHE_TTL], client=r)
+
+def rebuild_notes_cache(r):
+    """Rakenna koko muistiinpanovälimuisti tietokannasta (kylmä käynnistys). Palauttaa alkiot uusimmasta alkaen.
+
+    Sukupolvi luetaan ennen kyselyä. Jos jokin päivitys ehtii välimuistiin kyselyn jälkeen, rakennus hylätään
+    (WATCH), ettei vanha tilannekuva pyyhi uudempaa muutosta.
+    """
+    global notes_cache_dirty
+    generation = None
+    if r:
+        try:
+            generation = r.get(NOTES_GEN_KEY)
+        except redis.RedisError:
+            r = None
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT id, title, content, created_at, updated_at, revision FROM notes ORDER BY id DESC")
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    
+    with span('json'):
+        items = [note_json(row) for row in rows]
+    if r:
+        try:
+            with r.pipeline() as pipe:
+                pipe.watch(NOTES_GEN_KEY)
+                if pipe.get(NOTES_GEN_KEY) == generation:
+                    pipe.multi()
+                    with span('compress'):
+                        queue_notes_rebuild(pipe, rows, items)
+                    pipe.execute()
+                    notes_cache_dirty = False
+        except redis.RedisError:  # myös WatchError: välimuisti muuttui, seuraava luku yrittää uudelleen
+            pass
+    return items
+
 @app.route('/api/notes', methods=['GET', 'POST'])
 def notes():
     if request.method == 'POST':
@@ -139,48 +1137,70 @@ def notes():
         title = data.get('title', '') if data else ''
         if not content:
             return jsonify({"error": "content vaaditaan"}), 400
+        if '\x00' in f"{title}{content}":
+            return jsonify({"error": "NUL-merkit eivät ole sallittuja"}), 400  # PostgreSQL ei hyväksy niitä tekstiin
         
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO notes (title, content) VALUES (%s, %s) RETURNING id, created_at", (title or None, content,))
-        row = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
-        invalidate_cache()
+        # Write-behind: id selviää vasta purettaessa
+        if WRITE_BEHIND_ENABLED and enqueue_write("note", {"title": title or None, "content": content}):
+            return jsonify({"status": "vastaanotettu", "id": None}), 202
+        
+        try:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO notes (title, content) VALUES (%s, %s)
+                RETURNING id, title, content, created_at, updated_at, revision
+            """, (title or None, content,))
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            conn.close()
+        except psycopg2.Error:
+            return jsonify({"error": "Tietokanta ei käytettävissä"}), 503
+        patch_notes_cache(upserts=[row])
         return jsonify({"status": "tallennettu", "id": row[0]}), 201
     else:
+        # Valinnainen sivutus: ?limit=N&offset=M. Ilman limitiä palautetaan koko lista offsetista alkaen.
+        limit = request.args.get('limit', type=int)
+        offset = max(0, request.args.get('offset', 0, type=int))
+        if limit is not None:
+            limit = max(1, min(NOTES_PAGE_MAX, limit))
+        whole_list = limit is None and offset == 0  # vain koko listalla on valmiiksi pakatut versiot
+        
         # Yritä hakea välimuistista. Mikäli epäonnistuu, hae tietokannasta.
-        r = get_redis()
+        encoding = choose_encoding()
+        r = get_redis(binary=True)
+        if r and notes_cache_dirty:
+            invalidate_cache()
+        cached = None
         if r:
             try:
-                cached = r.get(CACHE_KEY)
-                if cached:
-                    return jsonify(json.loads(cached))
-            except:
+                if whole_list and encoding != 'identity':
+                    compressed = r.get(cache_variant_key(encoding))
+                    if compressed:
+                        return bytes_response(compressed, encoding)
+                cached = read_notes_cache(r, offset, limit)
+            except redis.RedisError:
                 pass
         
-        # Hae tietokannasta
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, title, content, created_at, updated_at FROM notes ORDER BY id DESC")
-        notes_list = [{
-            "id": row[0],
-            "title": row[1],
-            "content": row[2],
-            "created_at": row[3].isoformat() + 'Z' if row[3] else None,
-            "updated_at": row[4].isoformat() + 'Z' if row[4] else None
-        } for row in cur.fetchall()]
-        cur.close()
-        conn.close()
+        if cached is None:
+            # Kylmä välimuisti: rakennetaan kokonaan tietokannasta
+            items = rebuild_notes_cache(r)
+            if not whole_list:
+                items = items[offset:None if limit is None else offset + limit]
+            return bytes_response(json_array(items))
         
-        # Tallenna välimuistiin tietokannasta haettu data seuraavaa pyyntöä varten
-        if r:
+        generation, items = cached
+        payload = json_array(items)
+        if whole_list and encoding != 'identity' and len(payload) >= COMPRESSION_MIN_SIZE:
+            with span('compress'):
+                body = compress(payload, encoding)
             try:
-                r.setex(CACHE_KEY, CACHE_TTL, json.dumps(notes_list))
-            except:
+                store_notes_variant(r, generation, encoding, body)
+            except redis.RedisError:
                 pass
-        return jsonify(notes_list)
+            return bytes_response(body, encoding)
+        return bytes_response(payload)
 
 @app.route('/api/notes/<int:note_id>', methods=['PUT', 'DELETE'])
 def manage_note(note_id):
@@ -193,22 +1213,47 @@ def manage_note(note_id):
         if not content:
             return jsonify({"error": "content vaaditaan"}), 400
         
-        cur.execute("UPDATE notes SET content = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (content, note_id))
+        cur.execute("""
+            UPDATE notes SET content = %s, updated_at = CURRENT_TIMESTAMP, revision = revision + 1 WHERE id = %s
+            RETURNING id, title, content, created_at, updated_at, revision
+        """, (content, note_id))
+        row = cur.fetchone()
         conn.commit()
         cur.close()
         conn.close()
-        invalidate_cache()
+        if row:
+            patch_notes_cache(upserts=[row])
         return jsonify({"status": "päivitetty"}), 200
     else:  # DELETE
         cur.execute("DELETE FROM notes WHERE id = %s", (note_id,))
         conn.commit()
         cur.close()
         conn.close()
-        invalidate_cache()
+        patch_notes_cache(deletes=[note_id])
         return jsonify({"status": "poistettu"}), 200
 
 # MEMORY GAME REDIS API
 MEMORY_REDIS_KEY = "memory_saves"
+MEMORY_SUMMARY_KEY = "memory_saves_summary"  # nimi -> listauksen tarvitsema tiivistelmä
+
+def memory_summary(name, state):
+    """Muodosta tallennuslistauksen rivi pelitilasta."""
+    return {
+        "name": name,
+        "matched": state.get("matched", 0),
+        "totalPairs": state.get("totalPairs", 0),
+        "moves": state.get("moves", 0)
+    }
+
+def queue_memory_save(pipe, name, state):
+    """Lisää pipelineen pelitilan ja sen tiivistelmän tallennus."""
+    pipe.hset(MEMORY_REDIS_KEY, name, json.dumps(state))
+    pipe.hset(MEMORY_SUMMARY_KEY, name, json.dumps(memory_summary(name, state)))
+
+def queue_memory_delete(pipe, name):
+    """Lisää pipelineen pelitilan ja sen tiivistelmän poisto."""
+    pipe.hdel(MEMORY_REDIS_KEY, name)
+    pipe.hdel(MEMORY_SUMMARY_KEY, name)
 
 @app.route('/api/memory/save', methods=['POST'])
 def memory_save():
@@ -225,9 +1270,12 @@ def memory_save():
         return jsonify({"error": "Nimi vaaditaan"}), 400
     
     try:
-        r.hset(MEMORY_REDIS_KEY, name, json.dumps(state))
+        # Pelitila ja sen tiivistelmä kirjoitetaan samalla kierroksella (MULTI/EXEC)
+        pipe = r.pipeline()
+        queue_memory_save(pipe, name, state)
+        pipe.execute()
         return jsonify({"status": "tallennettu", "name": name}), 201
-    except Exception as e:
+    except redis.RedisError as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/memory/saves', methods=['GET'])
@@ -238,18 +1286,27 @@ def memory_list_saves():
         return jsonify([])
     
     try:
-        saves = r.hgetall(MEMORY_REDIS_KEY)
-        result = []
-        for name, state_json in saves.items():
-            state = json.loads(state_json)
-            result.append({
-                "name": name,
-                "matched": state.get("matched", 0),
-                "totalPairs": state.get("totalPairs", 0),
-                "moves": state.get("moves", 0)
-            })
+        # Listaus tarvitsee vain tiivistelmät, joten koko pelitiloja ei siirretä eikä jäsennetä.
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(MEMORY_SUMMARY_KEY)
+        pipe.hkeys(MEMORY_REDIS_KEY)
+        summaries, names = pipe.execute()
+
+        # Vanhoille tallennuksille ei ole tiivistelmää: lasketaan ne kerran ja tallennetaan.
+        missing = [name for name in names if name not in summaries]
+        if missing:
+            states = r.hmget(MEMORY_REDIS_KEY, missing)
+            backfill = {}
+            for name, state_json in zip(missing, states):
+                if state_json:
+                    backfill[name] = json.dumps(memory_summary(name, json.loads(state_json)))
+            if backfill:
+                r.hset(MEMORY_SUMMARY_KEY, mapping=backfill)
+                summaries.update(backfill)
+
+        result = [json.loads(summaries[name]) for name in names if name in summaries]
         return jsonify(result)
-    except Exception as e:
+    except (redis.RedisError, ValueError):
         return jsonify([])
 
 @app.route('/api/memory/load/<name>', methods=['GET'])
@@ -264,7 +1321,7 @@ def memory_load(name):
         if not state_json:
             return jsonify({"error": "Peliä ei löydy"}), 404
         return jsonify(json.loads(state_json))
-    except Exception as e:
+    except (redis.RedisError, ValueError) as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/memory/delete/<name>', methods=['DELETE'])
@@ -275,48 +1332,113 @@ def memory_delete(name):
         return jsonify({"error": "Redis ei käytettävissä"}), 503
     
     try:
-        r.hdel(MEMORY_REDIS_KEY, name)
+        pipe = r.pipeline()
+        queue_memory_delete(pipe, name)
+        pipe.execute()
         return jsonify({"status": "poistettu"}), 200
-    except Exception as e:
+    except redis.RedisError as e:
         return jsonify({"error": str(e)}), 500
 
 # MEMORY GAME SCOREBOARD API (PostgreSQL)
+GRID_SIZES = ['4x4', '6x6']
+SCOREBOARD_CACHE_PREFIX = "scoreboard_cache:"
+SCOREBOARD_CACHE_TTL = 300  # sekuntia, välimuisti tyhjennetään myös jokaisen uuden tuloksen jälkeen
+INT4_MAX = 2**31 - 1  # PostgreSQL INTEGER
+
+def valid_count(value):
+    """Positiivinen kokonaisluku, joka mahtuu INTEGER-sarakkeeseen."""
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value <= INT4_MAX
+
+def scoreboard_json(rows):
+    """Tulostaulun rivit (name, time_seconds, moves, created_at) JSON-tavuina sijoituksineen."""
+    result = []
+    for i, row in enumerate(rows):
+        result.append({
+            "rank": i + 1,
+            "name": row[0],
+            "time": row[1],
+            "moves": row[2],
+            "date": row[3].strftime("%d.%m.%Y") if row[3] else ""
+        })
+    return json.dumps(result).encode('utf-8')
+
+def load_scoreboard_cache(grid_size, r):
+    """Hae tulostaulu tietokannasta ja tallenna se välimuistiin. Palauttaa JSON-tavut."""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT name, time_seconds, moves, created_at 
+        FROM scoreboard 
+        WHERE grid_size = %s 
+        ORDER BY time_seconds ASC 
+        LIMIT 10
+    """, (grid_size,))
+    payload = scoreboard_json(cur.fetchall())
+    cur.close()
+    conn.close()
+    
+    if r:
+        try:
+            r.setex(SCOREBOARD_CACHE_PREFIX + grid_size, SCOREBOARD_CACHE_TTL, payload)
+        except redis.RedisError:
+            pass
+    return payload
+
+def trim_scoreboard(cur, grid_size):
+    """Pidä vain top 10 tulosta per ruudukon koko."""
+    cur.execute("""
+        DELETE FROM scoreboard WHERE id IN (
+            SELECT id FROM scoreboard 
+            WHERE grid_size = %s 
+            ORDER BY time_seconds ASC 
+            OFFSET 10
+        )
+    """, (grid_size,))
+
+def estimate_rank(grid_size, time_seconds):
+    """Arvioi sijoitus nykyisestä top 10 -listasta (write-behind, jolloin tulos ei ole vielä tietokannassa)."""
+    r = get_redis(binary=True)
+    try:
+        cached = r.get(SCOREBOARD_CACHE_PREFIX + grid_size) if r else None
+        scores = json.loads(cached or load_scoreboard_cache(grid_size, r))
+    except (redis.RedisError, psycopg2.Error, ValueError):
+        return None
+    return 1 + sum(1 for score in scores if score["time"] < time_seconds)
+
+def invalidate_scoreboard_cache(grid_size):
+    """Tyhjennä ruudukon koon tulostaulun välimuisti."""
+    r = get_redis()
+    if r:
+        try:
+            r.delete(SCOREBOARD_CACHE_PREFIX + grid_size)
+        except redis.RedisError:
+            pass
+
 @app.route('/api/memory/scoreboard/<grid_size>', methods=['GET'])
 def get_scoreboard(grid_size):
     """Hae tulostaulu (top 10 nopeinta aikaa)."""
-    if grid_size not in ['4x4', '6x6']:
+    if grid_size not in GRID_SIZES:
         return jsonify([]), 400
     
+    r = get_redis(binary=True)
+    if r:
+        try:
+            cached = r.get(SCOREBOARD_CACHE_PREFIX + grid_size)
+            if cached:
+                return bytes_response(cached)
+        except redis.RedisError:
+            pass
+    
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT name, time_seconds, moves, created_at 
-            FROM scoreboard 
-            WHERE grid_size = %s 
-            ORDER BY time_seconds ASC 
-            LIMIT 10
-        """, (grid_size,))
-        
-        result = []
-        for i, row in enumerate(cur.fetchall()):
-            result.append({
-                "rank": i + 1,
-                "name": row[0],
-                "time": row[1],
-                "moves": row[2],
-                "date": row[3].strftime("%d.%m.%Y") if row[3] else ""
-            })
-        cur.close()
-        conn.close()
-        return jsonify(result)
+        return bytes_response(load_scoreboard_cache(grid_size, r))
     except Exception as e:
         return jsonify([])
 
 @app.route('/api/memory/scoreboard/<grid_size>', methods=['POST'])
+@expensive
 def add_to_scoreboard(grid_size):
     """Lisää tulos tulostaululle."""
-    if grid_size not in ['4x4', '6x6']:
+    if grid_size not in GRID_SIZES:
         return jsonify({"error": "Virheellinen ruudukon koko"}), 400
     
     data = request.get_json()
@@ -326,8 +1448,17 @@ def add_to_scoreboard(grid_size):
     
     if not name:
         return jsonify({"error": "Nimi vaaditaan"}), 400
-    if time_seconds <= 0:
+    # Tarkistetaan ennen write-behind-jonoa, jottei virheellinen arvo kaada purkua vasta myöhemmin
+    if not valid_count(time_seconds):
         return jsonify({"error": "Virheellinen aika"}), 400
+    if not valid_count(moves):
+        return jsonify({"error": "Virheellinen siirtomäärä"}), 400
+    
+    if WRITE_BEHIND_ENABLED and enqueue_write("score", {"grid_size": grid_size, "name": name, "time": time_seconds, "moves": moves}):
+        return jsonify({
+            "status": "vastaanotettu",
+            "rank": estimate_rank(grid_size, time_seconds)
+        }), 202
     
     try:
         conn = get_db()
@@ -347,19 +1478,12 @@ def add_to_scoreboard(grid_size):
         """, (grid_size, time_seconds))
         rank = cur.fetchone()[0] + 1
         
-        # Pidä vain top 10 tulosta per ruudukon koko
-        cur.execute("""
-            DELETE FROM scoreboard WHERE id IN (
-                SELECT id FROM scoreboard 
-                WHERE grid_size = %s 
-                ORDER BY time_seconds ASC 
-                OFFSET 10
-            )
-        """, (grid_size,))
+        trim_scoreboard(cur, grid_size)
         conn.commit()
         
         cur.close()
         conn.close()
+        invalidate_scoreboard_cache(grid_size)
         
         return jsonify({
             "status": "tallennettu",
@@ -804,13 +1928,30 @@ IMAGE_FORM = """
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 
+# IMAGE_FORM ei sisällä muuttujia, joten se renderöidään ja pakataan vain kerran (warm-up tai ensimmäinen pyyntö).
+image_form_variants = None
+
+def get_image_form_variants():
+    """Renderöity lomakesivu tavuina kaikkina pakkausversioina."""
+    global image_form_variants
+    if image_form_variants is None:
+        with app.app_context():
+            rendered = render_template_string(IMAGE_FORM).encode('utf-8')
+        image_form_variants = encode_variants(rendered)
+    return image_form_variants
+
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @app.route('/api/image', methods=['GET', 'POST'])
+@expensive
 def process_image():
     if request.method == 'GET':
-        return render_template_string(IMAGE_FORM)
+        variants = get_image_form_variants()
+        encoding = choose_encoding()
+        if encoding not in variants:
+            encoding = 'identity'
+        return bytes_response(variants[encoding], encoding, mimetype='text/html')
 
     file = request.files.get('image')
     if not file or not allowed_file(file.filename):
@@ -823,10 +1964,20 @@ def process_image():
         percentage = 50
 
     try:
-        img = Image.open(file).convert("RGB")
+        png = scatter_pixels(file.read(), percentage)
     except UnidentifiedImageError:
         return "Virhe: tiedosto ei ole kelvollinen kuva.", 400
 
+    return send_file(io.BytesIO(png), mimetype="image/png", download_name="muokattu.png")
+
+def scatter_pixels(image_bytes, percentage):
+    """Säilytä satunnaisesti valittu osuus pikseleistä ja muuta loput mustiksi. Palauttaa PNG-tavut.
+
+    Moduulitason funktio, jotta ASGI-tila voi ajaa sen prosessipoolissa.
+    """
+    with span('image.decode'):
+        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
     arr = np.array(img)
     total_pixels = arr.shape[0] * arr.shape[1]
     keep_pixels = max(1, int(total_pixels * (percentage / 100)))
@@ -843,11 +1994,44 @@ def process_image():
 
     output_img = Image.fromarray(output_arr)
     output = io.BytesIO()
-    output_img.save(output, format="PNG")
-    output.seek(0)
+    with span('image.encode'):
+        output_img.save(output, format="PNG")
+    return output.getvalue()
+
+# WARM-UP
+# Käynnistyksen jälkeen välimuistit täytetään taustalla, jotta ensimmäiset kävijät eivät maksa kylmää polkua.
+def warm_up():
+    """Täytä muistiinpanojen ja tulostaulujen välimuistit ja renderöi staattiset sivut valmiiksi."""
+    start = time.perf_counter()
+    get_image_form_variants()
+    r = get_redis(binary=True)
+    steps = [("muistiinpanot", lambda: rebuild_notes_cache(r))]
+    steps += [(f"tulostaulu {size}", lambda size=size: load_scoreboard_cache(size, r)) for size in GRID_SIZES]
+    for name, step in steps:
+        try:
+            step()
+        except (psycopg2.Error, redis.RedisError) as e:
+            # Epäonnistunut esilämmitys ei estä palvelua: välimuisti täyttyy silloin ensimmäisestä pyynnöstä.
+            print(f"Warm-up ohitti vaiheen '{name}': {e}")
+    app_ready.set()
+    print(f"Warm-up valmis ({(time.perf_counter() - start) * 1000:.0f} ms)")
+
+def start_background_tasks():
+    """Käynnistä warm-up, riippuvuustarkistin ja tarvittaessa write-behind-purkaja taustasäikeinä."""
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    threading.Thread(target=dependency_prober, name="dependency-prober", daemon=True).start()
+    if WRITE_BEHIND_ENABLED:
+        threading.Thread(target=write_behind_flusher, name="write-behind", daemon=True).start()
 
-    return send_file(output, mimetype="image/png", download_name="muokattu.png")
+# Palvelutila: "sync" = Flaskin säikeistetty palvelin (oletus), "asgi" = asynkroninen polku (asgi.py, uvicorn)
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
 
 if __name__ == "__main__":
-    init_db()  # Alusta tietokanta käynnistyksessä
-    app.run(host="0.0.0.0", port=5000)
+    if SERVER_MODE == 'asgi':
+        import uvicorn
+        # asgi.py alustaa tietokannan ja käynnistää taustasäikeet lifespan-vaiheessa
+        uvicorn.run("asgi:app", host="0.0.0.0", port=5000, log_level="warning")
+    else:
+        init_db()  # Alusta tietokanta käynnistyksessä
+        start_background_tasks()
+        app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,695 @@
+# Asynkroninen (ASGI) palvelupolku I/O-sidonnaisille päätepisteille. Käynnistyy, kun SERVER_MODE=asgi (ks. app.py).
+# Muistiinpanot, muistipelin tallennukset ja tulostaulu odottavat lähes koko ajan PostgreSQLää ja Redistä, joten ne
+# ajetaan tapahtumasilmukassa asyncpg- ja redis.asyncio-yhteyspoolien kautta: hidas asiakas ei varaa kokonaista säiettä.
+# Kuvankäsittely on CPU-sidonnaista ja ajetaan prosessipoolissa. Muut päätepisteet (health, ready, metrics, version,
+# kuvalomake, profilointi) välitetään sellaisenaan Flask-sovellukselle.
+# URL:t, JSON-muodot, pakkaus ja jäljitys ovat samat kuin app.py:ssä. Välimuistiavaimet, Lua-skriptit, rajoittimen ja katkaisijan tila
+# sekä apufunktiot tulevat app.py:stä, joten molemmat tilat lukevat ja kirjoittavat samaa välimuistia.
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import wraps
+import multiprocessing
+import asyncio
+import json
+import math
+import os
+import time
+import uuid
+
+from a2wsgi import WSGIMiddleware
+from PIL import UnidentifiedImageError
+from starlette.applications import Starlette
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_accept_header
+import asyncpg
+import redis
+import redis.asyncio as aioredis
+
+import app as core
+
+ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', '2'))
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', '20'))
+ASYNC_DB_TIMEOUT = float(os.environ.get('ASYNC_DB_TIMEOUT', '5'))  # sekuntia, kysely ja yhteyden odotus
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+
+# tietokantavirheet, joista vastataan 503 eikä kaaduta
+DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+# Lifespan-vaiheessa luotavat resurssit
+db_pool = None
+redis_client = None
+redis_binary_client = None
+image_executor = None
+expensive_slots = None
+scripts = {}  # Lua-skriptit asiakaskohtaisesti rekisteröityinä
+
+class InstrumentedAsyncPipeline(aioredis.client.Pipeline):
+    """Pipeline, jonka execute() mitataan yhtenä Redis-kierroksena (sama katkaisija kuin synkronisella puolella)."""
+
+    async def execute(self, raise_on_error=True):
+        with core.redis_call():
+            return await super().execute(raise_on_error)
+
+class InstrumentedAsyncRedis(aioredis.Redis):
+    """Asynkroninen Redis-asiakas, joka mittaa jokaisen komennon ja syöttää virheet katkaisijalle."""
+
+    async def execute_command(self, *args, **options):
+        with core.redis_call():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def get_redis(binary=False):
+    """Hae jaettu asynkroninen Redis-asiakas. Palauttaa None, jos katkaisija on auki."""
+    if core.redis_circuit_open():
+        with core.redis_lock:
+            core.redis_state["skipped"] += 1
+        return None
+    return redis_binary_client if binary else redis_client
+
+async def run_script(r, source, keys, args):
+    """Aja Lua-skripti EVALSHA:lla (rekisteröidään kerran asiakasta kohden)."""
+    key = (id(r), source)
+    if key not in scripts:
+        scripts[key] = r.register_script(source)
+    return await scripts[key](keys=keys, args=args, client=r)
+
+# VASTAUKSET
+
+def choose_encoding(headers):
+    """Valitse pyynnön Accept-Encoding-otsikon perusteella pakkaus, tai 'identity'."""
+    accept = parse_accept_header(headers.get('accept-encoding'))
+    for encoding in core.available_encodings():
+        if accept[encoding] > 0:
+            return encoding
+    return 'identity'
+
+def bytes_response(body, encoding='identity', status=200):
+    """Palauta valmiiksi serialisoitu (ja mahdollisesti pakattu) JSON sellaisenaan."""
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(body, status_code=status, media_type='application/json', headers=headers)
+
+def json_response(data, status=200):
+    """Serialisoi JSON. CompressionMiddleware pakkaa sen, jos vastaus ylittää pakkausrajan."""
+    with core.span('json'):
+        payload = json.dumps(data).encode('utf-8')
+    return bytes_response(payload, status=status)
+
+class CompressionMiddleware:
+    """Pakkaa riittävän suuret JSON-vastaukset samoin säännöin kuin app.compress_response (pakkaus säiepoolissa).
+
+    Käsittelijän jo pakkaamat vastaukset (Content-Encoding) ja suoratoistetut vastaukset välitetään sellaisenaan.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = None
+
+        async def compressing_send(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if start is None or message.get('more_body'):
+                if start is not None:
+                    await send(start)
+                    start = None
+                return await send(message)
+            headers = MutableHeaders(scope=start)
+            body = message.get('body', b'')
+            if (headers.get('content-type', '').split(';')[0] == 'application/json'
+                    and 'content-encoding' not in headers and 200 <= start['status'] < 300):
+                if 'accept-encoding' not in headers.get('vary', '').lower():
+                    headers.add_vary_header('Accept-Encoding')
+                encoding = choose_encoding(Headers(scope=scope))
+                if encoding != 'identity' and len(body) >= core.COMPRESSION_MIN_SIZE:
+                    with core.span('compress'):
+                        body = await asyncio.to_thread(core.compress, body, encoding)
+                    headers['Content-Encoding'] = encoding
+                    headers['Content-Length'] = str(len(body))
+            await send(start)
+            start = None
+            await send({**message, 'body': body})
+
+        await self.app(scope, receive, compressing_send)
+
+class TracingMiddleware:
+    """Aikavälit, Server-Timing-otsikko ja hitaiden pyyntöjen loki kuten app.start_trace/finish_trace."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not core.TRACING_ENABLED or scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        spans = []
+        token = core.trace_spans.set(spans)
+        start = time.perf_counter()
+
+        async def traced_send(message):
+            if message['type'] == 'http.response.start':
+                total_ms = (time.perf_counter() - start) * 1000
+                timing = core.report_trace(scope['method'], scope['path'], message['status'], spans, total_ms)
+                MutableHeaders(scope=message)['Server-Timing'] = timing
+            await send(message)
+
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            core.trace_spans.reset(token)
+
+class TracedConnection(asyncpg.Connection):
+    """Tietokantayhteys, jonka kyselyt näkyvät jäljityksessä db-aikavälinä (vrt. app.TracedCursor)."""
+
+    async def execute(self, *args, **kwargs):
+        with core.span('db'):
+            return await super().execute(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        with core.span('db'):
+            return await super().fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        with core.span('db'):
+            return await super().fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        with core.span('db'):
+            return await super().fetchval(*args, **kwargs)
+
+def too_busy(error, status, retry_after):
+    """Ylikuormavastaus Retry-After-otsikolla."""
+    return JSONResponse({"error": error}, status_code=status,
+                        headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+async def read_json(request):
+    """Pyynnön JSON-runko kuten Flaskin request.get_json(): 415 jos runko ei ole JSONia, 400 jos se on virheellinen."""
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if not (mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))):
+        raise HTTPException(415)
+    try:
+        return await request.json()
+    except ValueError:
+        raise HTTPException(400)
+
+def query_int(request, name, default=None):
+    """Kokonaislukuparametri kuten Flaskin request.args.get(name, default, type=int): virheellinen arvo ohitetaan."""
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+# PYYNTÖRAJOITUS JA KUORMANHALLINTA (samat asetukset ja Redis-ämpärit kuin app.py:ssä)
+
+def limited(endpoint):
+    """Token bucket -rajoitus. endpoint on Flask-päätepisteen nimi, jolla hinta haetaan RATE_LIMIT_COSTS-taulukosta."""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            if core.RATE_LIMIT_ENABLED:
+                r = get_redis()
+                if r:
+                    cost = core.RATE_LIMIT_COSTS.get((endpoint, request.method), 1)
+                    ip = request.headers.get('x-real-ip') or (request.client.host if request.client else 'unknown')
+                    try:
+                        allowed, retry_after = await run_script(
+                            r, core.TOKEN_BUCKET_LUA, [core.RATE_LIMIT_PREFIX + ip],
+                            [core.RATE_LIMIT_RATE, core.RATE_LIMIT_BURST, cost])
+                    except redis.RedisError:
+                        allowed = 1
+                    if int(allowed) != 1:
+                        with core.admission_lock:
+                            core.admission_state["rate_limited"] += 1
+                        return too_busy("Liian monta pyyntöä, yritä hetken kuluttua uudelleen", 429, float(retry_after))
+            return await handler(request)
+        return wrapper
+    return decorator
+
+def expensive(handler):
+    """Rajoita raskaiden pyyntöjen samanaikaista määrää. Jonotus kestää enintään EXPENSIVE_QUEUE_TIMEOUT."""
+    @wraps(handler)
+    async def wrapper(request):
+        try:
+            await asyncio.wait_for(expensive_slots.acquire(), core.EXPENSIVE_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            with core.admission_lock:
+                core.admission_state["overloaded"] += 1
+            return too_busy("Palvelu on ylikuormitettu, yritä hetken kuluttua uudelleen", 503, 1)
+        with core.admission_lock:
+            core.admission_state["expensive_in_flight"] += 1
+        try:
+            return await handler(request)
+        finally:
+            with core.admission_lock:
+                core.admission_state["expensive_in_flight"] -= 1
+            expensive_slots.release()
+    return wrapper
+
+async def enqueue_write(request, kind, data):
+    """Lisää kirjoitus write-behind-streamiin. Palauttaa idempotenssiavaimen, tai None jos Redis ei ole käytettävissä."""
+    r = get_redis()
+    if not r:
+        return None
+    key = (request.headers.get('idempotency-key') or uuid.uuid4().hex)[:64]
+    try:
+        await r.xadd(core.WRITE_BEHIND_STREAM, {"kind": kind, "key": key, "data": json.dumps(data)})
+        return key
+    except redis.RedisError:
+        return None
+
+# NOTES API
+
+async def invalidate_cache():
+    """Merkitse muistiinpanovälimuisti vanhentuneeksi, jolloin seuraava luku rakentaa sen uudelleen."""
+    r = get_redis()
+    if r:
+        try:
+            await r.delete(core.NOTES_READY_KEY, *[core.cache_variant_key(e) for e in core.available_encodings()])
+            core.notes_cache_dirty = False
+            return
+        except redis.RedisError:
+            pass
+    core.notes_cache_dirty = True
+
+async def patch_notes_cache(upserts=(), deletes=()):
+    """Päivitä välimuistiin vain muuttuneet muistiinpanot."""
+    r = get_redis()
+    if r and not core.notes_cache_dirty:
+        try:
+            await run_script(r, core.NOTES_PATCH_LUA, *core.notes_patch_keys_args(upserts, deletes))
+            return
+        except redis.RedisError:
+            pass
+    await invalidate_cache()
+
+async def rebuild_notes_cache(r):
+    """Rakenna koko muistiinpanovälimuisti tietokannasta. Palauttaa alkiot uusimmasta alkaen.
+
+    Rakennus hylätään, jos sukupolvi muuttuu kyselyn aikana (ks. app.rebuild_notes_cache).
+    """
+    generation = None
+    if r:
+        try:
+            generation = await r.get(core.NOTES_GEN_KEY)
+        except redis.RedisError:
+            r = None
+    rows = await db_pool.fetch("SELECT id, title, content, created_at, updated_at, revision FROM notes ORDER BY id DESC")
+    with core.span('json'):
+        items = [core.note_json(row) for row in rows]
+    if r:
+        try:
+            async with r.pipeline() as pipe:
+                await pipe.watch(core.NOTES_GEN_KEY)
+                if await pipe.get(core.NOTES_GEN_KEY) == generation:
+                    pipe.multi()
+                    await asyncio.to_thread(core.queue_notes_rebuild, pipe, rows, items)
+                    await pipe.execute()
+                    core.notes_cache_dirty = False
+        except redis.RedisError:
+            pass
+    return items
+
+@limited('notes')
+async def notes(request):
+    if request.method == 'POST':
+        data = await read_json(request)
+        content = data.get('content', '') if data else ''
+        title = data.get('title', '') if data else ''
+        if not content:
+            return JSONResponse({"error": "content vaaditaan"}, status_code=400)
+        if '\x00' in f"{title}{content}":
+            return JSONResponse({"error": "NUL-merkit eivät ole sallittuja"}, status_code=400)
+
+        if core.WRITE_BEHIND_ENABLED and await enqueue_write(request, "note", {"title": title or None, "content": content}):
+            return JSONResponse({"status": "vastaanotettu", "id": None}, status_code=202)
+
+        try:
+            row = await db_pool.fetchrow("""
+                INSERT INTO notes (title, content) VALUES ($1, $2)
+                RETURNING id, title, content, created_at, updated_at, revision
+            """, title or None, content)
+        except DB_ERRORS:
+            return JSONResponse({"error": "Tietokanta ei käytettävissä"}, status_code=503)
+        await patch_notes_cache(upserts=[row])
+        return JSONResponse({"status": "tallennettu", "id": row["id"]}, status_code=201)
+
+    limit = query_int(request, 'limit')
+    offset = max(0, query_int(request, 'offset', 0))
+    if limit is not None:
+        limit = max(1, min(core.NOTES_PAGE_MAX, limit))
+    whole_list = limit is None and offset == 0
+
+    encoding = choose_encoding(request.headers)
+    r = get_redis(binary=True)
+    if r and core.notes_cache_dirty:
+        await invalidate_cache()
+    cached = None
+    if r:
+        try:
+            if whole_list and encoding != 'identity':
+                compressed = await r.get(core.cache_variant_key(encoding))
+                if compressed:
+                    return bytes_response(compressed, encoding)
+            result = await run_script(r, core.NOTES_READ_LUA,
+                                      [core.NOTES_READY_KEY, core.NOTES_IDS_KEY, core.NOTES_ITEMS_KEY, core.NOTES_GEN_KEY],
+                                      [offset, -1 if limit is None else limit])
+            if result is not None:
+                cached = result[0], result[1:]
+        except redis.RedisError:
+            pass
+
+    if cached is None:
+        try:
+            items = await rebuild_notes_cache(r)
+        except DB_ERRORS:
+            return JSONResponse({"error": "Tietokanta ei käytettävissä"}, status_code=503)
+        if not whole_list:
+            items = items[offset:None if limit is None else offset + limit]
+        return bytes_response(core.json_array(items))
+
+    generation, items = cached
+    payload = core.json_array(items)
+    if whole_list and encoding != 'identity' and len(payload) >= core.COMPRESSION_MIN_SIZE:
+        with core.span('compress'):
+            body = await asyncio.to_thread(core.compress, payload, encoding)
+        try:
+            await run_script(r, core.NOTES_STORE_VARIANT_LUA,
+                             [core.NOTES_GEN_KEY, core.cache_variant_key(encoding)],
+                             [generation, body, core.CACHE_TTL])
+        except redis.RedisError:
+            pass
+        return bytes_response(body, encoding)
+    return bytes_response(payload)
+
+@limited('manage_note')
+async def manage_note(request):
+    note_id = request.path_params['note_id']
+    if request.method == 'PUT':
+        data = await read_json(request)
+        content = data.get('content', '') if data else ''
+        if not content:
+            return JSONResponse({"error": "content vaaditaan"}, status_code=400)
+        try:
+            row = await db_pool.fetchrow("""
+                UPDATE notes SET content = $1, updated_at = CURRENT_TIMESTAMP, revision = revision + 1 WHERE id = $2
+                RETURNING id, title, content, created_at, updated_at, revision
+            """, content, note_id)
+        except DB_ERRORS:
+            return JSONResponse({"error": "Tietokanta ei käytettävissä"}, status_code=503)
+        if row:
+            await patch_notes_cache(upserts=[row])
+        return JSONResponse({"status": "päivitetty"})
+
+    try:
+        await db_pool.execute("DELETE FROM notes WHERE id = $1", note_id)
+    except DB_ERRORS:
+        return JSONResponse({"error": "Tietokanta ei käytettävissä"}, status_code=503)
+    await patch_notes_cache(deletes=[note_id])
+    return JSONResponse({"status": "poistettu"})
+
+# MEMORY GAME REDIS API
+
+@limited('memory_save')
+async def memory_save(request):
+    """Tallenna pelitila Redisiin nimellä."""
+    r = get_redis()
+    if not r:
+        return JSONResponse({"error": "Redis ei käytettävissä"}, status_code=503)
+
+    data = await read_json(request) or {}
+    name = data.get('name', '').strip()
+    state = data.get('state', {})
+
+    if not name:
+        return JSONResponse({"error": "Nimi vaaditaan"}, status_code=400)
+
+    try:
+        pipe = r.pipeline()
+        core.queue_memory_save(pipe, name, state)
+        await pipe.execute()
+        return JSONResponse({"status": "tallennettu", "name": name}, status_code=201)
+    except redis.RedisError as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@limited('memory_list_saves')
+async def memory_list_saves(request):
+    """Listaa kaikki tallennetut pelit."""
+    r = get_redis()
+    if not r:
+        return JSONResponse([])
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(core.MEMORY_SUMMARY_KEY)
+        pipe.hkeys(core.MEMORY_REDIS_KEY)
+        summaries, names = await pipe.execute()
+
+        missing = [name for name in names if name not in summaries]
+        if missing:
+            states = await r.hmget(core.MEMORY_REDIS_KEY, missing)
+            backfill = {}
+            for name, state_json in zip(missing, states):
+                if state_json:
+                    backfill[name] = json.dumps(core.memory_summary(name, json.loads(state_json)))
+            if backfill:
+                await r.hset(core.MEMORY_SUMMARY_KEY, mapping=backfill)
+                summaries.update(backfill)
+
+        result = [json.loads(summaries[name]) for name in names if name in summaries]
+        return json_response(result)
+    except (redis.RedisError, ValueError):
+        return JSONResponse([])
+
+@limited('memory_load')
+async def memory_load(request):
+    """Lataa tallennettu peli nimellä."""
+    r = get_redis()
+    if not r:
+        return JSONResponse({"error": "Redis ei käytettävissä"}, status_code=503)
+
+    try:
+        state_json = await r.hget(core.MEMORY_REDIS_KEY, request.path_params['name'])
+        if not state_json:
+            return JSONResponse({"error": "Peliä ei löydy"}, status_code=404)
+        return json_response(json.loads(state_json))
+    except (redis.RedisError, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@limited('memory_delete')
+async def memory_delete(request):
+    """Poista tallennettu peli."""
+    r = get_redis()
+    if not r:
+        return JSONResponse({"error": "Redis ei käytettävissä"}, status_code=503)
+
+    try:
+        pipe = r.pipeline()
+        core.queue_memory_delete(pipe, request.path_params['name'])
+        await pipe.execute()
+        return JSONResponse({"status": "poistettu"})
+    except redis.RedisError as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+# MEMORY GAME SCOREBOARD API (PostgreSQL)
+
+async def load_scoreboard_cache(grid_size, r):
+    """Hae tulostaulu tietokannasta ja tallenna se välimuistiin. Palauttaa JSON-tavut."""
+    rows = await db_pool.fetch("""
+        SELECT name, time_seconds, moves, created_at
+        FROM scoreboard
+        WHERE grid_size = $1
+        ORDER BY time_seconds ASC
+        LIMIT 10
+    """, grid_size)
+    payload = core.scoreboard_json(rows)
+    if r:
+        try:
+            await r.setex(core.SCOREBOARD_CACHE_PREFIX + grid_size, core.SCOREBOARD_CACHE_TTL, payload)
+        except redis.RedisError:
+            pass
+    return payload
+
+async def estimate_rank(grid_size, time_seconds):
+    """Arvioi sijoitus nykyisestä top 10 -listasta (write-behind)."""
+    r = get_redis(binary=True)
+    try:
+        cached = await r.get(core.SCOREBOARD_CACHE_PREFIX + grid_size) if r else None
+        scores = json.loads(cached or await load_scoreboard_cache(grid_size, r))
+    except (redis.RedisError, ValueError) + DB_ERRORS:
+        return None
+    return 1 + sum(1 for score in scores if score["time"] < time_seconds)
+
+@limited('get_scoreboard')
+async def get_scoreboard(request):
+    """Hae tulostaulu (top 10 nopeinta aikaa)."""
+    grid_size = request.path_params['grid_size']
+    if grid_size not in core.GRID_SIZES:
+        return JSONResponse([], status_code=400)
+
+    r = get_redis(binary=True)
+    if r:
+        try:
+            cached = await r.get(core.SCOREBOARD_CACHE_PREFIX + grid_size)
+            if cached:
+                return bytes_response(cached)
+        except redis.RedisError:
+            pass
+
+    try:
+        return bytes_response(await load_scoreboard_cache(grid_size, r))
+    except DB_ERRORS:
+        return JSONResponse([])
+
+@limited('add_to_scoreboard')
+@expensive
+async def add_to_scoreboard(request):
+    """Lisää tulos tulostaululle."""
+    grid_size = request.path_params['grid_size']
+    if grid_size not in core.GRID_SIZES:
+        return JSONResponse({"error": "Virheellinen ruudukon koko"}, status_code=400)
+
+    data = await read_json(request) or {}
+    name = data.get('name', '').strip()[:20]  # Rajoita nimen pituus
+    time_seconds = data.get('time', 0)
+    moves = data.get('moves', 0)
+
+    if not name:
+        return JSONResponse({"error": "Nimi vaaditaan"}, status_code=400)
+    if not core.valid_count(time_seconds):
+        return JSONResponse({"error": "Virheellinen aika"}, status_code=400)
+    if not core.valid_count(moves):
+        return JSONResponse({"error": "Virheellinen siirtomäärä"}, status_code=400)
+
+    if core.WRITE_BEHIND_ENABLED and await enqueue_write(
+            request, "score", {"grid_size": grid_size, "name": name, "time": time_seconds, "moves": moves}):
+        return JSONResponse({
+            "status": "vastaanotettu",
+            "rank": await estimate_rank(grid_size, time_seconds)
+        }, status_code=202)
+
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    INSERT INTO scoreboard (grid_size, name, time_seconds, moves)
+                    VALUES ($1, $2, $3, $4)
+                """, grid_size, name, time_seconds, moves)
+                rank = await conn.fetchval("""
+                    SELECT COUNT(*) FROM scoreboard
+                    WHERE grid_size = $1 AND time_seconds < $2
+                """, grid_size, time_seconds) + 1
+                await conn.execute("""
+                    DELETE FROM scoreboard WHERE id IN (
+                        SELECT id FROM scoreboard
+                        WHERE grid_size = $1
+                        ORDER BY time_seconds ASC
+                        OFFSET 10
+                    )
+                """, grid_size)
+    except DB_ERRORS as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    r = get_redis()
+    if r:
+        try:
+            await r.delete(core.SCOREBOARD_CACHE_PREFIX + grid_size)
+        except redis.RedisError:
+            pass
+    return JSONResponse({"status": "tallennettu", "rank": rank}, status_code=201)
+
+# IMAGE API (lomake tulee Flaskilta, käsittely prosessipoolissa)
+
+@limited('process_image')
+@expensive
+async def process_image(request):
+    form = await request.form()
+    file = form.get('image')
+    if not file or not hasattr(file, 'filename') or not core.allowed_file(file.filename):
+        return PlainTextResponse("Virhe: vain kuvatiedostot sallittu (PNG/JPG/JPEG/GIF/WEBP).", status_code=400)
+
+    try:
+        percentage = int(form.get('percentage', 50))
+        percentage = max(1, min(100, percentage))
+    except ValueError:
+        percentage = 50
+
+    image_bytes = await file.read()
+    loop = asyncio.get_running_loop()
+    try:
+        with core.span('image'):
+            png = await loop.run_in_executor(image_executor, core.scatter_pixels, image_bytes, percentage)
+    except UnidentifiedImageError:
+        return PlainTextResponse("Virhe: tiedosto ei ole kelvollinen kuva.", status_code=400)
+
+    return Response(png, media_type="image/png", headers={'Content-Disposition': 'inline; filename=muokattu.png'})
+
+# KÄYNNISTYS
+
+@asynccontextmanager
+async def lifespan(app):
+    """Alusta tietokanta ja yhteyspoolit, käynnistä taustasäikeet ja sulje kaikki lopuksi."""
+    global db_pool, redis_client, redis_binary_client, image_executor, expensive_slots
+    await asyncio.to_thread(core.init_db)
+    try:
+        db_pool = await asyncpg.create_pool(core.DATABASE_URL, min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX,
+                                            timeout=ASYNC_DB_TIMEOUT, command_timeout=ASYNC_DB_TIMEOUT,
+                                            connection_class=TracedConnection)
+    except DB_ERRORS as e:
+        # Tietokanta ei vielä vastaa: yhteydet avataan vasta tarvittaessa
+        print(f"Tietokantapoolin esiavaus epäonnistui: {e}")
+        db_pool = await asyncpg.create_pool(core.DATABASE_URL, min_size=0, max_size=ASYNC_DB_POOL_MAX,
+                                            timeout=ASYNC_DB_TIMEOUT, command_timeout=ASYNC_DB_TIMEOUT,
+                                            connection_class=TracedConnection)
+    pool_options = dict(
+        max_connections=core.REDIS_MAX_CONNECTIONS,
+        timeout=core.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=core.REDIS_CONNECT_TIMEOUT,
+        socket_timeout=core.REDIS_SOCKET_TIMEOUT,
+        health_check_interval=30,
+    )
+    redis_client = InstrumentedAsyncRedis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+        core.REDIS_URL, decode_responses=True, **pool_options))
+    redis_binary_client = InstrumentedAsyncRedis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+        core.REDIS_URL, **pool_options))
+    # spawn: taustasäikeitä sisältävää prosessia ei haarauteta (fork)
+    image_executor = ProcessPoolExecutor(IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    expensive_slots = asyncio.Semaphore(core.EXPENSIVE_CONCURRENCY)
+    core.start_background_tasks()
+    try:
+        yield
+    finally:
+        image_executor.shutdown(cancel_futures=True)
+        await db_pool.close()
+        await redis_client.aclose()
+        await redis_binary_client.aclose()
+
+# Pakkaus ja jäljitys vain asynkronisille reiteille: Flask hoitaa ne itse omille vastauksilleen (compress_response,
+# finish_trace), joten Mount-reitille niitä ei lisätä kahteen kertaan.
+ASYNC_MIDDLEWARE = [Middleware(TracingMiddleware), Middleware(CompressionMiddleware)]
+
+routes = [
+    Route('/api/notes', notes, methods=['GET', 'POST'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/notes/{note_id:int}', manage_note, methods=['PUT', 'DELETE'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/save', memory_save, methods=['POST'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/saves', memory_list_saves, methods=['GET'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/load/{name}', memory_load, methods=['GET'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/delete/{name}', memory_delete, methods=['DELETE'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/scoreboard/{grid_size}', get_scoreboard, methods=['GET'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/memory/scoreboard/{grid_size}', add_to_scoreboard, methods=['POST'], middleware=ASYNC_MIDDLEWARE),
+    Route('/api/image', process_image, methods=['POST'], middleware=ASYNC_MIDDLEWARE),
+    # Kaikki muu Flaskille (ajetaan a2wsgi:n säiepoolissa)
+    Mount('/', app=WSGIMiddleware(core.app)),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,109 @@
+# Kuormitustesti: synkroninen (Flask) vs. asynkroninen (ASGI) palvelutila hitaiden asiakkaiden alla.
+# Avaa joukon hitaita yhteyksiä, jotka lähettävät pyyntönsä tavu kerrallaan (kuten mobiiliasiakas huonolla yhteydellä),
+# ja mittaa samaan aikaan tavallisten asiakkaiden vasteajat ja läpäisyn sekä API:n säikeiden määrän (/ready).
+# Vain standardikirjasto, joten skripti toimii suoraan API-kontissa:
+#
+#   docker compose cp bench/slow_clients.py api:/tmp/slow_clients.py
+#   docker compose exec api python /tmp/slow_clients.py --url http://127.0.0.1:5000 --slow 1000
+#
+# Aja sama komento SERVER_MODE=sync ja SERVER_MODE=asgi -tiloissa ja vertaa tuloksia. Aseta testin ajaksi
+# RATE_LIMIT_ENABLED=0, muuten pyyntörajoitin hylkää kuormituksen ennen kuin palvelutilojen ero näkyy.
+# Testi ajetaan API:a vasten suoraan, koska nginx puskuroi hitaat pyynnöt eikä päästä niitä API:lle asti.
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+async def slow_client(host, port, path, trickle, stats):
+    """Lähetä pyyntö tavu kerrallaan trickle sekunnin aikana ja lue vastaus."""
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nX-Real-IP: 10.0.{stats['slow_started'] % 250}.1\r\nConnection: close\r\n\r\n".encode()
+    stats['slow_started'] += 1
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        delay = trickle / len(request)
+        for i in range(len(request)):
+            writer.write(request[i:i + 1])
+            await writer.drain()
+            await asyncio.sleep(delay)
+        status = await reader.readline()
+        await reader.read()
+        writer.close()
+        stats['slow_ok' if b' 200 ' in status else 'slow_failed'] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        stats['slow_failed'] += 1
+
+async def fetch(host, port, path, timeout, client_id=1):
+    """Yksi tavallinen HTTP/1.1-pyyntö. Palauttaa (tilakoodi, runko)."""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nX-Real-IP: 10.1.0.{client_id}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    raw = await asyncio.wait_for(reader.read(), timeout)
+    writer.close()
+    head, _, body = raw.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), body
+
+async def fast_client(host, port, path, deadline, timeout, client_id, latencies, stats):
+    """Tee pyyntöjä peräkkäin testin loppuun asti ja kirjaa vasteajat."""
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            status, _ = await fetch(host, port, path, timeout, client_id)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                stats['fast_failed'] += 1
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+            stats['fast_failed'] += 1
+
+async def sample_threads(host, port, deadline, samples):
+    """Lue API:n säikeiden määrä /ready-päätepisteestä kerran sekunnissa."""
+    while time.monotonic() < deadline:
+        try:
+            _, body = await fetch(host, port, "/ready", 5)
+            samples.append(json.loads(body)["checks"]["workers"]["threads"])
+        except (OSError, asyncio.TimeoutError, ValueError, KeyError, IndexError):
+            pass
+        await asyncio.sleep(1)
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] * 1000 if len(values) >= 2 else float('nan')
+
+async def main(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    stats = {'slow_started': 0, 'slow_ok': 0, 'slow_failed': 0, 'fast_failed': 0}
+    latencies, threads = [], []
+    deadline = time.monotonic() + args.duration
+
+    # Hitaat asiakkaat avataan porrastetusti ensimmäisen sekunnin aikana
+    slow = []
+    for i in range(args.slow):
+        slow.append(asyncio.create_task(slow_client(host, port, args.path, args.trickle, stats)))
+        if i % 50 == 49:
+            await asyncio.sleep(0.05)
+    fast = [asyncio.create_task(fast_client(host, port, args.path, deadline, args.timeout, i + 1, latencies, stats))
+            for i in range(args.fast)]
+    sampler = asyncio.create_task(sample_threads(host, port, deadline, threads))
+    await asyncio.gather(*fast, sampler)
+    await asyncio.gather(*slow)
+
+    print(f"Kohde:             {args.url}{args.path}")
+    print(f"Hitaat asiakkaat:  {args.slow} ({args.trickle:.0f} s/pyyntö), onnistui {stats['slow_ok']}, epäonnistui {stats['slow_failed']}")
+    print(f"Nopeat asiakkaat:  {args.fast}, {len(latencies)} onnistunutta pyyntöä, {stats['fast_failed']} epäonnistui")
+    print(f"Läpäisy:           {len(latencies) / args.duration:.1f} pyyntöä/s")
+    print(f"Vasteaika p50/p95/p99: {percentile(latencies, 50):.1f} / {percentile(latencies, 95):.1f} / {percentile(latencies, 99):.1f} ms")
+    if threads:
+        print(f"API:n säikeet:     enintään {max(threads)}, keskimäärin {statistics.mean(threads):.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hitaiden asiakkaiden kuormitustesti")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="API:n osoite (ilman nginxiä)")
+    parser.add_argument("--path", default="/api/notes", help="testattava polku")
+    parser.add_argument("--slow", type=int, default=500, help="hitaiden yhteyksien määrä")
+    parser.add_argument("--trickle", type=float, default=10, help="sekuntia, jonka hidas asiakas käyttää pyynnön lähettämiseen")
+    parser.add_argument("--fast", type=int, default=20, help="samanaikaisten tavallisten asiakkaiden määrä")
+    parser.add_argument("--duration", type=float, default=15, help="testin kesto sekunteina")
+    parser.add_argument("--timeout", type=float, default=10, help="yksittäisen pyynnön aikaraja sekunteina")
+    asyncio.run(main(parser.parse_args()))